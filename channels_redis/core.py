@@ -101,9 +101,7 @@ class ConnectionPool:
         Close all connections owned by the pool on the given loop.
         """
         if loop in self.conn_map:
-            for conn in self.conn_map[loop]:
-                conn.close()
-                await conn.wait_closed()
+            await self._close_connections(self.conn_map[loop])
             del self.conn_map[loop]
 
         for k, v in self.in_use.items():
@@ -117,13 +115,18 @@ class ConnectionPool:
         conn_map = self.conn_map
         in_use = self.in_use
         self.reset()
-        for conns in conn_map.values():
-            for conn in conns:
-                conn.close()
-                await conn.wait_closed()
-        for conn in in_use:
+        await self._close_connections(
+            itertools.chain(itertools.chain.from_iterable(conn_map.values()), in_use)
+        )
+
+    async def _close_connections(self, conns):
+        """
+        Close the given connections, waiting for all of them concurrently.
+        """
+        conns = list(conns)
+        for conn in conns:
             conn.close()
-            await conn.wait_closed()
+        await asyncio.gather(*[conn.wait_closed() for conn in conns])
 
 
 class ChannelLock:
@@ -172,8 +175,23 @@ class ReceiveBuffer:
     
     It manages waiters and buffers messages for all specific channels under the same 'real channel'
     Also manages the receive loop for the 'real channel'
+
+    All specific channels under one real channel share a single Redis list,
+    so one blocking pop on it serves every waiting getter at once. Buffers
+    for different real channels each run their own loop on their own
+    connection, so they wait concurrently rather than one after another.
     """
 
+    __slots__ = (
+        "loop",
+        "real_channel",
+        "receive_single",
+        "getters",
+        "buffers",
+        "receiver",
+        "idle",
+    )
+
     def __init__(self, receive_single, real_channel):
         self.loop = None
         self.real_channel = real_channel
@@ -181,6 +199,9 @@ class ReceiveBuffer:
         self.getters = collections.defaultdict(collections.deque)
         self.buffers = collections.defaultdict(collections.deque)
         self.receiver = None
+        # Set whenever no receive loop is running
+        self.idle = asyncio.Event()
+        self.idle.set()
 
     def __bool__(self):
         return bool(self.getters)
@@ -194,11 +215,13 @@ class ReceiveBuffer:
             self.real_channel
         ), "channel not managed by this buffer"
         getter = self.loop.create_future()
+        buffers = self.buffers
 
-        if channel in self.buffers:
-            getter.set_result(self.buffers[channel].popleft())
-            if not self.buffers[channel]:
-                del self.buffers[channel]
+        if channel in buffers:
+            buffer = buffers[channel]
+            getter.set_result(buffer.popleft())
+            if not buffer:
+                del buffers[channel]
         else:
             getter.channel = channel
             getter.add_done_callback(self._getter_done_prematurely)
@@ -206,6 +229,7 @@ class ReceiveBuffer:
 
             # ensure receiver is running
             if not self.receiver:
+                self.idle.clear()
                 self.receiver = asyncio.ensure_future(self.receiver_factory())
         return getter
 
@@ -218,26 +242,32 @@ class ReceiveBuffer:
             self.receiver.cancel()
 
     def put(self, channel, message):
-        if channel in self.getters:
-            getter = self.getters[channel].popleft()
+        getters = self.getters
+        if channel in getters:
+            channel_getters = getters[channel]
+            getter = channel_getters.popleft()
             getter.remove_done_callback(self._getter_done_prematurely)
-            if not self.getters[channel]:
-                del self.getters[channel]
+            if not channel_getters:
+                del getters[channel]
             getter.set_result(message)
         else:
             self.buffers[channel].append(message)
 
     async def receiver_factory(self):
+        receive_single = self.receive_single
+        real_channel = self.real_channel
+        put = self.put
         try:
             while self:
-                message_channel, message = await self.receive_single(self.real_channel)
+                message_channel, message = await receive_single(real_channel)
                 if type(message_channel) is list:
                     for chan in message_channel:
-                        self.put(chan, message)
+                        put(chan, message)
                 else:
-                    self.put(message_channel, message)
+                    put(message_channel, message)
         finally:
             self.receiver = None
+            self.idle.set()
 
 
 class RedisChannelLayer(BaseChannelLayer):
@@ -251,6 +281,63 @@ class RedisChannelLayer(BaseChannelLayer):
 
     brpop_timeout = 5
 
+    # Lua scripts are constant so they can be run by their precomputed
+    # SHA1 digest (see _eval_script).
+
+    # Check the length of the list, push onto the list then set it to
+    # expire in case it's not consumed, all in a single script call
+    _SEND_LUA = """
+        if redis.call('LLEN', KEYS[1]) >= tonumber(ARGV[2]) then
+            return 0
+        end
+        redis.call('LPUSH', KEYS[1], ARGV[1])
+        redis.call('EXPIRE', KEYS[1], ARGV[3])
+        return 1
+    """
+    _SEND_SHA = hashlib.sha1(_SEND_LUA.encode("utf8")).hexdigest()
+
+    # Pop messages from the processing queue and push them in front of the
+    # main message queue in the proper order; BRPOP must *not* be called
+    # because that would deadlock the server. Then try a non-blocking
+    # RPOPLPUSH, so a message that is already waiting costs a single round trip.
+    _CLEANUP_LUA = """
+        local backed_up = redis.call('LRANGE', ARGV[2], 0, -1)
+        for i = #backed_up, 1, -1 do
+            redis.call('LPUSH', ARGV[1], backed_up[i])
+        end
+        redis.call('DEL', ARGV[2])
+        return redis.call('RPOPLPUSH', ARGV[1], ARGV[2])
+    """
+    _CLEANUP_SHA = hashlib.sha1(_CLEANUP_LUA.encode("utf8")).hexdigest()
+
+    # Delete every key matching a pattern. UNLINK frees the memory in a
+    # background thread; servers older than Redis 4.0 don't have it, so fall
+    # back to DEL.
+    _DELETE_PREFIX_LUA = """
+        local keys = redis.call('keys', ARGV[1])
+        local delete = 'unlink'
+        for i=1,#keys,5000 do
+            local last = math.min(i+4999, #keys)
+            if type(redis.pcall(delete, unpack(keys, i, last))) == 'table' then
+                delete = 'del'
+                redis.call(delete, unpack(keys, i, last))
+            end
+        end
+    """
+    _DELETE_PREFIX_SHA = hashlib.sha1(_DELETE_PREFIX_LUA.encode("utf8")).hexdigest()
+
+    # Push a message onto every key whose list is below its capacity. ARGV
+    # holds the messages, then the capacities, then the shared expiry.
+    _GROUP_SEND_LUA = """
+        for i=1,#KEYS do
+            if redis.call('LLEN', KEYS[i]) < tonumber(ARGV[i + #KEYS]) then
+                redis.call('LPUSH', KEYS[i], ARGV[i])
+                redis.call('EXPIRE', KEYS[i], ARGV[#ARGV])
+            end
+        end
+    """
+    _GROUP_SEND_SHA = hashlib.sha1(_GROUP_SEND_LUA.encode("utf8")).hexdigest()
+
     def __init__(
         self,
         hosts=None,
@@ -281,6 +368,9 @@ class RedisChannelLayer(BaseChannelLayer):
         self.client_prefix = "".join(
             random.choice(string.ascii_letters) for i in range(8)
         )
+        # Counter for the local part of new channel names; the client prefix
+        # already makes them unique across processes
+        self._channel_counter = itertools.count()
         # Set up any encryption objects
         self._setup_encryption(symmetric_encryption_keys)
         # Buffered messages by process-local channel name
@@ -344,28 +434,30 @@ class RedisChannelLayer(BaseChannelLayer):
         assert self.valid_channel_name(channel), "Channel name not valid"
         # Make sure the message does not contain reserved keys
         assert "__asgi_channel__" not in message
-        # If it's a process-local channel, strip off local part and stick full name in message
-        channel_non_local_name = channel
+        # Pick a connection to the right server - consistent for specific
+        # channels, random for general channels
         if "!" in channel:
+            # If it's a process-local channel, strip off local part and stick full name in message
             message = dict(message.items())
             message["__asgi_channel__"] = channel
             channel_non_local_name = self.non_local_name(channel)
-        # Write out message into expiring key (avoids big items in list)
-        channel_key = self.prefix + channel_non_local_name
-        # Pick a connection to the right server - consistent for specific
-        # channels, random for general channels
-        if "!" in channel:
             index = self.consistent_hash(channel)
         else:
+            channel_non_local_name = channel
             index = next(self._send_index_generator)
+        # Write out message into expiring key (avoids big items in list)
+        channel_key = self.prefix + channel_non_local_name
+        args = [self.serialize(message), self.get_capacity(channel), int(self.expiry)]
         async with self.connection(index) as connection:
-            # Check the length of the list before send
-            # This can allow the list to leak slightly over capacity, but that's fine.
-            if await connection.llen(channel_key) >= self.get_capacity(channel):
-                raise ChannelFull()
-            # Push onto the list then set it to expire in case it's not consumed
-            await connection.lpush(channel_key, self.serialize(message))
-            await connection.expire(channel_key, int(self.expiry))
+            sent = await self._eval_script(
+                connection,
+                self._SEND_LUA,
+                self._SEND_SHA,
+                keys=[channel_key],
+                args=args,
+            )
+        if not sent:
+            raise ChannelFull()
 
     def _backup_channel_name(self, channel):
         """
@@ -378,21 +470,20 @@ class RedisChannelLayer(BaseChannelLayer):
         Perform a Redis BRPOP and manage the backup processing queue.
         In case of cancellation, make sure the message is not lost.
         """
-        # The script will pop messages from the processing queue and push them in front
-        # of the main message queue in the proper order; BRPOP must *not* be called
-        # because that would deadlock the server
-        cleanup_script = """
-            local backed_up = redis.call('LRANGE', ARGV[2], 0, -1)
-            for i = #backed_up, 1, -1 do
-                redis.call('LPUSH', ARGV[1], backed_up[i])
-            end
-            redis.call('DEL', ARGV[2])
-        """
         backup_queue = self._backup_channel_name(channel)
         async with self.connection(index) as connection:
-            # Cancellation here doesn't matter, we're not doing anything destructive
-            # and the script executes atomically...
-            await connection.eval(cleanup_script, keys=[], args=[channel, backup_queue])
+            # Cancellation here doesn't lose anything: the script executes atomically,
+            # and a message it pops waits in the backup queue until the next
+            # cleanup restores it to the main queue...
+            content = await self._eval_script(
+                connection,
+                self._CLEANUP_LUA,
+                self._CLEANUP_SHA,
+                keys=[],
+                args=[channel, backup_queue],
+            )
+            if content is not None:
+                return content
             # ...and it doesn't matter here either, the message will be safe in the backup.
             return await connection.brpoplpush(channel, backup_queue, timeout=timeout)
 
@@ -498,12 +589,7 @@ class RedisChannelLayer(BaseChannelLayer):
         Returns a new channel name that can be used by something in our
         process as a specific channel.
         """
-        # TODO: Guarantee uniqueness better?
-        return "%s.%s!%s" % (
-            prefix,
-            self.client_prefix,
-            "".join(random.choice(string.ascii_letters) for i in range(12)),
-        )
+        return "%s.%s!%x" % (prefix, self.client_prefix, next(self._channel_counter))
 
     ### Flush extension ###
 
@@ -515,17 +601,18 @@ class RedisChannelLayer(BaseChannelLayer):
         # keys from under their feet.
         await self.wait_received()
 
-        # Lua deletion script
-        delete_prefix = """
-            local keys = redis.call('keys', ARGV[1])
-            for i=1,#keys,5000 do
-                redis.call('del', unpack(keys, i, math.min(i+4999, #keys)))
-            end
-        """
-        # Go through each connection and remove all with prefix
-        for i in range(self.ring_size):
-            async with self.connection(i) as connection:
-                await connection.eval(delete_prefix, keys=[], args=[self.prefix + "*"])
+        async def _flush_shard(index):
+            async with self.connection(index) as connection:
+                await self._eval_script(
+                    connection,
+                    self._DELETE_PREFIX_LUA,
+                    self._DELETE_PREFIX_SHA,
+                    keys=[],
+                    args=[self.prefix + "*"],
+                )
+
+        # Go through each connection concurrently and remove all with prefix
+        await asyncio.gather(*[_flush_shard(i) for i in range(self.ring_size)])
         # Now clear the pools as well
         await self.close_pools()
 
@@ -537,8 +624,7 @@ class RedisChannelLayer(BaseChannelLayer):
         # pools without flushing first.
         await self.wait_received()
 
-        for pool in self.pools:
-            await pool.close()
+        await asyncio.gather(*[pool.close() for pool in self.pools])
 
     async def wait_received(self):
         """
@@ -597,42 +683,56 @@ class RedisChannelLayer(BaseChannelLayer):
             channel_names, message
         )
 
-        for connection_index, channel_redis_keys in connection_to_channel_keys.items():
-
-            # Create a LUA script specific for this connection.
-            # Make sure to use the message specific to this channel, it is
-            # stored in channel_to_message dict and contains the
-            # __asgi_channel__ key.
-
-            group_send_lua = (
-                """
-                    for i=1,#KEYS do
-                        if redis.call('LLEN', KEYS[i]) < tonumber(ARGV[i + #KEYS]) then
-                            redis.call('LPUSH', KEYS[i], ARGV[i])
-                            redis.call('EXPIRE', KEYS[i], %d)
-                        end
-                    end
-                    """
-                % self.expiry
-            )
-
-            # We need to filter the messages to keep those related to the connection
-            args = [
-                channel_keys_to_message[channel_key]
-                for channel_key in channel_redis_keys
-            ]
-
-            # We need to send the capacity for each channel
-            args += [
-                channel_keys_to_capacity[channel_key]
-                for channel_key in channel_redis_keys
+        # Send to each shard concurrently, one script call per shard
+        await asyncio.gather(
+            *[
+                self._group_send_to_connection(
+                    connection_index,
+                    channel_redis_keys,
+                    channel_keys_to_message,
+                    channel_keys_to_capacity,
+                )
+                for connection_index, channel_redis_keys in connection_to_channel_keys.items()
             ]
+        )
 
-            # channel_keys does not contain a single redis key more than once
-            async with self.connection(connection_index) as connection:
-                await connection.eval(
-                    group_send_lua, keys=channel_redis_keys, args=args
-                )
+    async def _group_send_to_connection(
+        self,
+        connection_index,
+        channel_redis_keys,
+        channel_keys_to_message,
+        channel_keys_to_capacity,
+    ):
+        """
+        Pushes the group message onto every channel key that lives on a
+        single shard, in one Lua script call.
+        """
+        # Make sure to use the message specific to this channel, it is
+        # stored in channel_to_message dict and contains the
+        # __asgi_channel__ key.
+
+        # We need to filter the messages to keep those related to the connection
+        args = [
+            channel_keys_to_message[channel_key] for channel_key in channel_redis_keys
+        ]
+
+        # We need to send the capacity for each channel
+        args += [
+            channel_keys_to_capacity[channel_key] for channel_key in channel_redis_keys
+        ]
+
+        # And the expiry, shared by all channels
+        args.append(int(self.expiry))
+
+        # channel_keys does not contain a single redis key more than once
+        async with self.connection(connection_index) as connection:
+            await self._eval_script(
+                connection,
+                self._GROUP_SEND_LUA,
+                self._GROUP_SEND_SHA,
+                keys=channel_redis_keys,
+                args=args,
+            )
 
     def _map_channel_to_connection(self, channel_names, message):
         """
@@ -690,13 +790,11 @@ class RedisChannelLayer(BaseChannelLayer):
 
         # For each channel
         for channel in channel_names:
-            channel_non_local_name = channel
-            if "!" in channel:
-                channel_non_local_name = self.non_local_name(channel)
+            channel_non_local_name = self.non_local_name(channel)
             # Get its redis key
             channel_key = self.prefix + channel_non_local_name
             # Have we come across the same redis key?
-            if channel_key not in channel_key_to_message.keys():
+            if channel_key not in channel_key_to_message:
                 # If not, fill the corresponding dicts
                 message = dict(message.items())
                 message["__asgi_channel__"] = [channel]
@@ -730,6 +828,10 @@ class RedisChannelLayer(BaseChannelLayer):
     def serialize(self, message):
         """
         Serializes message to a byte string.
+
+        This uses msgpack rather than JSON because ASGI messages carry raw
+        bytes (e.g. HTTP bodies, binary WebSocket frames), and because every
+        process sharing the Redis server must agree on the wire format.
         """
         value = msgpack.packb(message, use_bin_type=True)
         if self.crypter:
@@ -750,13 +852,32 @@ class RedisChannelLayer(BaseChannelLayer):
         """
         Maps the value to a node value between 0 and 4095
         using CRC, then down to one of the ring nodes.
+
+        Every process sharing the hosts must map values identically, so
+        the algorithm must not depend on optional packages.
         """
+        # With a single host everything maps to it; skip the hashing.
+        if self.ring_size == 1:
+            return 0
         if isinstance(value, str):
             value = value.encode("utf8")
         bigval = binascii.crc32(value) & 0xFFF
         ring_divisor = 4096 / float(self.ring_size)
         return int(bigval / ring_divisor)
 
+    async def _eval_script(self, connection, script, digest, keys, args):
+        """
+        Runs a Lua script by its precomputed SHA1 digest, so the script body is
+        only sent to the server the first time. Falls back to a plain EVAL
+        (which also caches the script) if the server does not know the digest yet.
+        """
+        try:
+            return await connection.evalsha(digest, keys=keys, args=args)
+        except aioredis.ReplyError as e:
+            if not str(e).startswith("NOSCRIPT"):
+                raise
+        return await connection.eval(script, keys=keys, args=args)
+
     def make_fernet(self, key):
         """
         Given a single encryption key, returns a Fernet instance using it.
@@ -1,12 +1,21 @@
 import asyncio
 
-import async_timeout
 import pytest
 from async_generator import async_generator, yield_
 
 from asgiref.sync import async_to_sync
 from channels_redis.core import ChannelFull, ReceiveBuffer, RedisChannelLayer
 
+try:
+    from asyncio import timeout as async_timeout
+except ImportError:  # Python < 3.11
+    from async_timeout import timeout as async_timeout
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
 TEST_HOSTS = [("localhost", 6379)]
 
 MULTIPLE_TEST_HOSTS = [
@@ -23,28 +32,46 @@ MULTIPLE_TEST_HOSTS = [
 ]
 
 
+@pytest.fixture(scope="session", autouse=True)
+def _uvloop_policy():
+    """
+    Runs the tests on uvloop if it is installed.
+    """
+    if uvloop is None:
+        yield
+        return
+    original_policy = asyncio.get_event_loop_policy()
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    yield
+    asyncio.set_event_loop_policy(original_policy)
+
+
 @pytest.fixture()
 @async_generator
-async def channel_layer():
+async def channel_layer(request):
     """
-    Channel layer fixture that flushes automatically.
+    Channel layer fixture that flushes automatically, unless the test is
+    marked with no_flush.
     """
     channel_layer = RedisChannelLayer(
         hosts=TEST_HOSTS, capacity=3, channel_capacity={"tiny": 1}
     )
     await yield_(channel_layer)
-    await channel_layer.flush()
+    if request.node.get_closest_marker("no_flush") is None:
+        await channel_layer.flush()
 
 
 @pytest.fixture()
 @async_generator
-async def channel_layer_multiple_hosts():
+async def channel_layer_multiple_hosts(request):
     """
-    Channel layer fixture that flushes automatically.
+    Channel layer fixture that flushes automatically, unless the test is
+    marked with no_flush.
     """
     channel_layer = RedisChannelLayer(hosts=MULTIPLE_TEST_HOSTS, capacity=3)
     await yield_(channel_layer)
-    await channel_layer.flush()
+    if request.node.get_closest_marker("no_flush") is None:
+        await channel_layer.flush()
 
 
 @pytest.mark.asyncio
@@ -60,6 +87,48 @@ async def test_send_receive(channel_layer):
     assert message["text"] == "Ahoy-hoy!"
 
 
+@pytest.mark.asyncio
+async def test_send_receive_bytes(channel_layer):
+    """
+    Makes sure bytes values survive serialization as bytes.
+    """
+    await channel_layer.send(
+        "test-channel-1", {"type": "test.message", "bytes": b"\x00\xffAhoy"}
+    )
+    message = await channel_layer.receive("test-channel-1")
+    assert message["bytes"] == b"\x00\xffAhoy"
+
+
+@pytest.mark.asyncio
+async def test_receive_restores_backup(channel_layer):
+    """
+    Makes sure a message left in the backup queue by a cancelled receive is
+    put back and received again.
+    """
+    channel_key = channel_layer.prefix + "test-channel-1"
+    async with channel_layer.connection(0) as connection:
+        await connection.lpush(
+            channel_layer._backup_channel_name(channel_key),
+            channel_layer.serialize({"type": "message.1"}),
+        )
+    await channel_layer.send("test-channel-1", {"type": "message.2"})
+
+    async with async_timeout(1):
+        received = {
+            (await channel_layer.receive("test-channel-1"))["type"],
+            (await channel_layer.receive("test-channel-1"))["type"],
+        }
+    assert received == {"message.1", "message.2"}
+
+    # Both messages have been cleaned from the backup queue
+    await channel_layer.wait_received()
+    async with channel_layer.connection(0) as connection:
+        assert await connection.llen(channel_key) == 0
+        assert (
+            await connection.llen(channel_layer._backup_channel_name(channel_key)) == 0
+        )
+
+
 @pytest.mark.parametrize("channel_layer", [None])  # Fixture can't handle sync
 def test_double_receive(channel_layer):
     """
@@ -69,15 +138,18 @@ def test_double_receive(channel_layer):
     channel_layer = RedisChannelLayer(hosts=TEST_HOSTS, capacity=3)
 
     # Aioredis connections can't be used from different event loops, so
-    # send and close need to be done in the same async_to_sync call.
-    async def send_and_close(*args, **kwargs):
-        await channel_layer.send(*args, **kwargs)
+    # sends and close need to be done in the same async_to_sync call.
+    async def setup():
+        channel_name_1 = await channel_layer.new_channel()
+        channel_name_2 = await channel_layer.new_channel()
+        await asyncio.gather(
+            channel_layer.send(channel_name_1, {"type": "test.message.1"}),
+            channel_layer.send(channel_name_2, {"type": "test.message.2"}),
+        )
         await channel_layer.close_pools()
+        return channel_name_1, channel_name_2
 
-    channel_name_1 = async_to_sync(channel_layer.new_channel)()
-    channel_name_2 = async_to_sync(channel_layer.new_channel)()
-    async_to_sync(send_and_close)(channel_name_1, {"type": "test.message.1"})
-    async_to_sync(send_and_close)(channel_name_2, {"type": "test.message.2"})
+    channel_name_1, channel_name_2 = async_to_sync(setup)()
 
     # Make things to listen on the loops
     async def listen1():
@@ -137,21 +209,35 @@ async def test_process_local_send_receive(channel_layer):
     assert message["text"] == "Local only please"
 
 
+@pytest.mark.no_flush
+@pytest.mark.asyncio
+async def test_new_channel_unique(channel_layer):
+    """
+    Makes sure new_channel never hands out the same name twice.
+    """
+    names = [await channel_layer.new_channel() for _ in range(100)]
+    assert len(set(names)) == len(names)
+    for name in names:
+        assert channel_layer.valid_channel_name(name)
+        assert channel_layer.non_local_name(name) == "specific.%s!" % (
+            channel_layer.client_prefix
+        )
+
+
 @pytest.mark.asyncio
 async def test_multi_send_receive(channel_layer):
     """
     Tests overlapping sends and receives, and ordering.
     """
-    channel_layer = RedisChannelLayer(hosts=TEST_HOSTS)
     await channel_layer.send("test-channel-3", {"type": "message.1"})
     await channel_layer.send("test-channel-3", {"type": "message.2"})
     await channel_layer.send("test-channel-3", {"type": "message.3"})
     assert (await channel_layer.receive("test-channel-3"))["type"] == "message.1"
     assert (await channel_layer.receive("test-channel-3"))["type"] == "message.2"
     assert (await channel_layer.receive("test-channel-3"))["type"] == "message.3"
-    await channel_layer.flush()
 
 
+@pytest.mark.no_flush
 @pytest.mark.asyncio
 async def test_reject_bad_channel(channel_layer):
     """
@@ -163,6 +249,7 @@ async def test_reject_bad_channel(channel_layer):
         await channel_layer.receive("=+135!")
 
 
+@pytest.mark.no_flush
 @pytest.mark.asyncio
 async def test_reject_bad_client_prefix(channel_layer):
     """
@@ -177,7 +264,6 @@ async def test_groups_basic(channel_layer):
     """
     Tests basic group operation.
     """
-    channel_layer = RedisChannelLayer(hosts=TEST_HOSTS)
     channel_name1 = await channel_layer.new_channel(prefix="test-gr-chan-1")
     channel_name2 = await channel_layer.new_channel(prefix="test-gr-chan-2")
     channel_name3 = await channel_layer.new_channel(prefix="test-gr-chan-3")
@@ -187,14 +273,13 @@ async def test_groups_basic(channel_layer):
     await channel_layer.group_discard("test-group", channel_name2)
     await channel_layer.group_send("test-group", {"type": "message.1"})
     # Make sure we get the message on the two channels that were in
-    async with async_timeout.timeout(1):
+    async with async_timeout(1):
         assert (await channel_layer.receive(channel_name1))["type"] == "message.1"
         assert (await channel_layer.receive(channel_name3))["type"] == "message.1"
     # Make sure the removed channel did not get the message
     with pytest.raises(asyncio.TimeoutError):
-        async with async_timeout.timeout(1):
+        async with async_timeout(1):
             await channel_layer.receive(channel_name2)
-    await channel_layer.flush()
 
 
 @pytest.mark.asyncio
@@ -202,14 +287,12 @@ async def test_groups_channel_full(channel_layer):
     """
     Tests that group_send ignores ChannelFull
     """
-    channel_layer = RedisChannelLayer(hosts=TEST_HOSTS)
     await channel_layer.group_add("test-group", "test-gr-chan-1")
     await channel_layer.group_send("test-group", {"type": "message.1"})
     await channel_layer.group_send("test-group", {"type": "message.1"})
     await channel_layer.group_send("test-group", {"type": "message.1"})
     await channel_layer.group_send("test-group", {"type": "message.1"})
     await channel_layer.group_send("test-group", {"type": "message.1"})
-    await channel_layer.flush()
 
 
 @pytest.mark.asyncio
@@ -217,27 +300,28 @@ async def test_groups_multiple_hosts(channel_layer_multiple_hosts):
     """
     Tests advanced group operation with multiple hosts.
     """
-    channel_layer = RedisChannelLayer(hosts=MULTIPLE_TEST_HOSTS, capacity=100)
-    channel_name1 = await channel_layer.new_channel(prefix="channel1")
-    channel_name2 = await channel_layer.new_channel(prefix="channel2")
-    channel_name3 = await channel_layer.new_channel(prefix="channel3")
-    await channel_layer.group_add("test-group", channel_name1)
-    await channel_layer.group_add("test-group", channel_name2)
-    await channel_layer.group_add("test-group", channel_name3)
-    await channel_layer.group_discard("test-group", channel_name2)
-    await channel_layer.group_send("test-group", {"type": "message.1"})
-    await channel_layer.group_send("test-group", {"type": "message.1"})
+    channel_name1 = await channel_layer_multiple_hosts.new_channel(prefix="channel1")
+    channel_name2 = await channel_layer_multiple_hosts.new_channel(prefix="channel2")
+    channel_name3 = await channel_layer_multiple_hosts.new_channel(prefix="channel3")
+    await channel_layer_multiple_hosts.group_add("test-group", channel_name1)
+    await channel_layer_multiple_hosts.group_add("test-group", channel_name2)
+    await channel_layer_multiple_hosts.group_add("test-group", channel_name3)
+    await channel_layer_multiple_hosts.group_discard("test-group", channel_name2)
+    await channel_layer_multiple_hosts.group_send("test-group", {"type": "message.1"})
+    await channel_layer_multiple_hosts.group_send("test-group", {"type": "message.1"})
 
     # Make sure we get the message on the two channels that were in
-    async with async_timeout.timeout(1):
-        assert (await channel_layer.receive(channel_name1))["type"] == "message.1"
-        assert (await channel_layer.receive(channel_name3))["type"] == "message.1"
+    async with async_timeout(1):
+        assert (await channel_layer_multiple_hosts.receive(channel_name1))[
+            "type"
+        ] == "message.1"
+        assert (await channel_layer_multiple_hosts.receive(channel_name3))[
+            "type"
+        ] == "message.1"
 
     with pytest.raises(asyncio.TimeoutError):
-        async with async_timeout.timeout(1):
-            await channel_layer.receive(channel_name2)
-
-    await channel_layer.flush()
+        async with async_timeout(1):
+            await channel_layer_multiple_hosts.receive(channel_name2)
 
 
 @pytest.mark.asyncio
@@ -245,7 +329,6 @@ async def test_groups_same_prefix(channel_layer):
     """
     Tests group_send with multiple channels with same channel prefix
     """
-    channel_layer = RedisChannelLayer(hosts=TEST_HOSTS)
     channel_name1 = await channel_layer.new_channel(prefix="test-gr-chan")
     channel_name2 = await channel_layer.new_channel(prefix="test-gr-chan")
     channel_name3 = await channel_layer.new_channel(prefix="test-gr-chan")
@@ -255,13 +338,11 @@ async def test_groups_same_prefix(channel_layer):
     await channel_layer.group_send("test-group", {"type": "message.1"})
 
     # Make sure we get the message on the channels that were in
-    async with async_timeout.timeout(1):
+    async with async_timeout(1):
         assert (await channel_layer.receive(channel_name1))["type"] == "message.1"
         assert (await channel_layer.receive(channel_name2))["type"] == "message.1"
         assert (await channel_layer.receive(channel_name3))["type"] == "message.1"
 
-    await channel_layer.flush()
-
 
 @pytest.mark.parametrize(
     "num_channels,timeout",
@@ -279,23 +360,24 @@ async def test_groups_multiple_hosts_performance(
     Tests advanced group operation: can send efficiently to multiple channels
     with multiple hosts within a certain timeout
     """
-    channel_layer = RedisChannelLayer(hosts=MULTIPLE_TEST_HOSTS, capacity=100)
-
-    channels = []
-    for i in range(0, num_channels):
-        channel = await channel_layer.new_channel(prefix="channel%s" % i)
-        await channel_layer.group_add("test-group", channel)
-        channels.append(channel)
+    channels = [
+        await channel_layer_multiple_hosts.new_channel(prefix="channel%s" % i)
+        for i in range(0, num_channels)
+    ]
+    for channel in channels:
+        await channel_layer_multiple_hosts.group_add("test-group", channel)
 
-    async with async_timeout.timeout(timeout):
-        await channel_layer.group_send("test-group", {"type": "message.1"})
+    async with async_timeout(timeout):
+        await channel_layer_multiple_hosts.group_send(
+            "test-group", {"type": "message.1"}
+        )
 
     # Make sure we get the message all the channels
-    async with async_timeout.timeout(timeout):
+    async with async_timeout(timeout):
         for channel in channels:
-            assert (await channel_layer.receive(channel))["type"] == "message.1"
-
-    await channel_layer.flush()
+            assert (await channel_layer_multiple_hosts.receive(channel))[
+                "type"
+            ] == "message.1"
 
 
 @pytest.mark.asyncio
@@ -319,30 +401,44 @@ async def test_group_send_capacity(channel_layer):
 
     # Make sure we do NOT recieve message 4
     with pytest.raises(asyncio.TimeoutError):
-        async with async_timeout.timeout(1):
+        async with async_timeout(1):
             await channel_layer.receive(channel)
 
 
 @pytest.mark.asyncio
-async def test_receive_cancel(channel_layer):
+async def test_group_send_script_flushed(channel_layer):
+    """
+    Makes sure group_send still works when Redis has dropped its script cache
+    """
+    channel = await channel_layer.new_channel()
+    await channel_layer.group_add("test-group", channel)
+
+    await channel_layer.group_send("test-group", {"type": "message.1"})
+    async with channel_layer.connection(0) as connection:
+        await connection.script_flush()
+    await channel_layer.group_send("test-group", {"type": "message.2"})
+
+    assert (await channel_layer.receive(channel))["type"] == "message.1"
+    assert (await channel_layer.receive(channel))["type"] == "message.2"
+
+
+@pytest.mark.parametrize("delay", [i / 1000 for i in range(10)])
+@pytest.mark.asyncio
+async def test_receive_cancel(channel_layer, delay):
     """
     Makes sure we can cancel a receive without blocking
     """
-    channel_layer = RedisChannelLayer(capacity=10)
     channel = await channel_layer.new_channel()
-    delay = 0
-    while delay < 0.01:
-        await channel_layer.send(channel, {"type": "test.message", "text": "Ahoy-hoy!"})
+    await channel_layer.send(channel, {"type": "test.message", "text": "Ahoy-hoy!"})
 
-        task = asyncio.ensure_future(channel_layer.receive(channel))
-        await asyncio.sleep(delay)
-        task.cancel()
-        delay += 0.001
+    task = asyncio.ensure_future(channel_layer.receive(channel))
+    await asyncio.sleep(delay)
+    task.cancel()
 
-        try:
-            await asyncio.wait_for(task, None)
-        except asyncio.CancelledError:
-            pass
+    try:
+        await asyncio.wait_for(task, None)
+    except asyncio.CancelledError:
+        pass
 
 
 @pytest.mark.asyncio
@@ -350,7 +446,6 @@ async def test_receive_multiple_specific_prefixes(channel_layer):
     """
     Makes sure we receive on multiple real channels
     """
-    channel_layer = RedisChannelLayer(capacity=10)
     channel1 = await channel_layer.new_channel()
     channel2 = await channel_layer.new_channel(prefix="thing")
     r1, _, r2 = tasks = [
@@ -368,6 +463,19 @@ async def test_receive_multiple_specific_prefixes(channel_layer):
     r1.cancel()
 
 
+def test_consistent_hash_is_stable():
+    """
+    Makes sure values keep mapping to the same shard, as every process
+    sharing the hosts must agree on it.
+    """
+    channel_layer = RedisChannelLayer(hosts=MULTIPLE_TEST_HOSTS)
+    assert channel_layer.consistent_hash("test-group") == 8
+    assert channel_layer.consistent_hash("specific.abcdefgh!") == 1
+    assert channel_layer.consistent_hash(b"channel1.xyz!") == 6
+    assert RedisChannelLayer(hosts=TEST_HOSTS).consistent_hash("test-group") == 0
+
+
+@pytest.mark.no_flush
 @pytest.mark.asyncio
 async def test_buffer_wrong_channel(channel_layer):
     async def dummy_receive(channel):
@@ -379,6 +487,7 @@ async def test_buffer_wrong_channel(channel_layer):
         buffer.get("wrong!13685sjmh")
 
 
+@pytest.mark.no_flush
 @pytest.mark.asyncio
 async def test_buffer_receiver_stopped(channel_layer):
     async def dummy_receive(channel):
@@ -388,9 +497,11 @@ async def test_buffer_receiver_stopped(channel_layer):
     buffer.loop = asyncio.get_event_loop()
 
     await buffer.get("whatever!meh")
+    await asyncio.wait_for(buffer.idle.wait(), timeout=1)
     assert buffer.receiver is None
 
 
+@pytest.mark.no_flush
 @pytest.mark.asyncio
 async def test_buffer_receiver_canceled(channel_layer):
     async def dummy_receive(channel):
@@ -406,5 +517,5 @@ async def test_buffer_receiver_canceled(channel_layer):
     get1.cancel()
     assert buffer.receiver is not None
     get2.cancel()
-    await asyncio.sleep(0.1)
+    await asyncio.wait_for(buffer.idle.wait(), timeout=1)
     assert buffer.receiver is None